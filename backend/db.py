@@ -0,0 +1,131 @@
+import os
+import asyncpg
+from typing import List, Optional
+from pgvector.asyncpg import register_vector
+from dotenv import load_dotenv
+
+# Direct asyncpg access to the Supabase Postgres database.
+#
+# The Supabase REST client is convenient but goes through PostgREST and
+# JSON; for hot paths (bulk chunk inserts) we talk to Postgres directly.
+# DATABASE_URL is the connection string from the Supabase dashboard
+# (Settings -> Database). If it is not set, callers fall back to the
+# REST client, so local setups keep working unchanged.
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+_pool: Optional[asyncpg.Pool] = None
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    # Register the pgvector codec so embeddings travel as binary vectors
+    # instead of JSON text (~5x less bandwidth, no parse on either side)
+    await register_vector(conn)
+
+
+async def get_pool() -> Optional[asyncpg.Pool]:
+    """Returns the shared connection pool, creating it on first use.
+
+    Returns None when DATABASE_URL is not configured.
+    """
+    global _pool
+    if _pool is None and DATABASE_URL:
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=1, max_size=10, init=_init_connection
+        )
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def copy_document_chunks(
+    pool: asyncpg.Pool,
+    user_id: str,
+    file_name: str,
+    chunks: List[str],
+    embeddings: List[List[float]],
+    content_hashes: List[str]
+) -> int:
+    """Bulk-loads chunk rows into documents via COPY.
+
+    COPY is Postgres's bulk-loader path and avoids building one huge JSON
+    payload that PostgREST parses row-by-row. Embeddings go through the
+    registered pgvector codec as binary. Returns the row count.
+    """
+    records = list(zip(
+        [user_id] * len(chunks),
+        [file_name] * len(chunks),
+        chunks,
+        embeddings,
+        content_hashes
+    ))
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table(
+            'documents',
+            records=records,
+            columns=['user_id', 'file_name', 'content', 'embedding', 'content_hash']
+        )
+    return len(records)
+
+
+async def fetch_embeddings_by_hash(
+    pool: asyncpg.Pool,
+    content_hashes: List[str]
+) -> dict:
+    """Returns {content_hash: embedding} for hashes already in documents.
+
+    Identical text always embeds to the same vector, so hits can be
+    reused across users and uploads without an API call.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT DISTINCT ON (content_hash) content_hash, embedding "
+            "FROM documents WHERE content_hash = ANY($1::text[])",
+            content_hashes
+        )
+    # Plain floats, not numpy.float32: these embeddings may end up in the
+    # JSON-serialized REST fallback insert, which can't encode numpy types
+    return {
+        row['content_hash']: [float(value) for value in row['embedding']]
+        for row in rows
+    }
+
+
+async def fetch_existing_hashes(
+    pool: asyncpg.Pool,
+    user_id: str,
+    content_hashes: List[str]
+) -> set:
+    """Returns the subset of hashes this user already has rows for."""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT content_hash FROM documents "
+            "WHERE user_id = $1 AND content_hash = ANY($2::text[])",
+            user_id, content_hashes
+        )
+    return {row['content_hash'] for row in rows}
+
+
+async def fetch_matching_documents(
+    pool: asyncpg.Pool,
+    query_embedding: List[float],
+    top_k: int,
+    user_id: str
+) -> List[str]:
+    """Runs match_documents over the binary protocol.
+
+    The query embedding is passed as a native parameter (binary vector)
+    rather than JSON-serialized through PostgREST.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT content FROM match_documents($1, $2, $3)",
+            query_embedding, top_k, user_id
+        )
+    return [row['content'] for row in rows]
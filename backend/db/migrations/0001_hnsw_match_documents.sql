@@ -0,0 +1,45 @@
+-- Speed up match_documents: HNSW index instead of a brute-force scan.
+-- Without an index, pgvector similarity search is linear in the size of
+-- the documents table; HNSW makes it sub-linear.
+--
+-- Apply via the Supabase SQL editor (or psql against the project DB).
+
+-- 1. HNSW index on the embedding column, inner-product ops to match the
+--    <#> ordering used by the function below.
+CREATE INDEX IF NOT EXISTS documents_embedding_hnsw
+    ON documents USING hnsw (embedding vector_ip_ops)
+    WITH (m = 16, ef_construction = 64);
+
+-- 2. Plain index for the per-user filter.
+CREATE INDEX IF NOT EXISTS documents_user_id_idx
+    ON documents (user_id);
+
+-- 3. Rewritten RPC. Same signature the backend already calls
+--    (rag_utils/processor.py -> supabase_client.rpc('match_documents', ...)).
+CREATE OR REPLACE FUNCTION match_documents(
+    query_embedding vector(768),
+    match_count int,
+    user_id_param text
+)
+RETURNS TABLE (
+    id bigint,
+    content text,
+    similarity float
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Widen the candidate list a little beyond match_count for better recall
+    SET LOCAL hnsw.ef_search = 40;
+
+    RETURN QUERY
+    SELECT
+        documents.id,
+        documents.content,
+        -(documents.embedding <#> query_embedding) AS similarity
+    FROM documents
+    WHERE documents.user_id = user_id_param
+    ORDER BY documents.embedding <#> query_embedding
+    LIMIT match_count;
+END;
+$$;
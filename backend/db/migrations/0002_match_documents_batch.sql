@@ -0,0 +1,41 @@
+-- Batch variant of match_documents: run the similarity search for N query
+-- embeddings in one SQL statement (one round-trip) instead of N RPCs.
+--
+-- Apply via the Supabase SQL editor (or psql against the project DB).
+
+CREATE OR REPLACE FUNCTION match_documents_batch(
+    query_embeddings vector(768)[],
+    match_count int,
+    user_id_param text
+)
+RETURNS TABLE (
+    query_index int,
+    id bigint,
+    content text,
+    similarity float
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    SET LOCAL hnsw.ef_search = 40;
+
+    RETURN QUERY
+    SELECT
+        q.ord::int - 1 AS query_index,
+        matched.id,
+        matched.content,
+        matched.similarity
+    FROM unnest(query_embeddings) WITH ORDINALITY AS q(qe, ord)
+    JOIN LATERAL (
+        SELECT
+            documents.id,
+            documents.content,
+            -(documents.embedding <#> q.qe) AS similarity
+        FROM documents
+        WHERE documents.user_id = user_id_param
+        ORDER BY documents.embedding <#> q.qe
+        LIMIT match_count
+    ) AS matched ON TRUE
+    ORDER BY query_index, matched.similarity DESC;
+END;
+$$;
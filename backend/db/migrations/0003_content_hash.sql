@@ -0,0 +1,18 @@
+-- Content-hash column for chunk dedup: identical chunks (re-uploads,
+-- shared boilerplate) can reuse an existing embedding instead of another
+-- embedding API call, and a re-uploaded file inserts no duplicate rows.
+--
+-- Apply via the Supabase SQL editor (or psql against the project DB).
+
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash text;
+
+-- Backfill is not required: rows with NULL hash simply never match the
+-- reuse lookup and keep working for retrieval.
+
+-- Lookup index for embedding reuse across all users
+CREATE INDEX IF NOT EXISTS documents_content_hash_idx
+    ON documents (content_hash);
+
+-- One row per (user, chunk): re-uploading the same file is a no-op
+CREATE UNIQUE INDEX IF NOT EXISTS documents_user_content_hash_key
+    ON documents (user_id, content_hash);
@@ -1,19 +1,20 @@
 import uvicorn
 import os
 import google.generativeai as genai
-import requests
-import json
+import httpx
+import orjson
 import asyncio
 from typing import List, Dict, Optional
 
 from fastapi import FastAPI, HTTPException, File, UploadFile
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 from supabase import create_client, Client
+import db
 from rag_utils.processor import (
-    retrieve_context, 
+    retrieve_context_async,
     generate_and_save_embeddings,
     extract_text_from_file
 )
@@ -40,7 +41,9 @@ class ResearchRequest(BaseModel):
     conversation_id: Optional[int] = None # Corrected type
 
 # --- 4. Create FastAPI App & Configure CORS ---
-app = FastAPI(title="AI Researcher Backend")
+# orjson handles response serialization; the stdlib json encoder is a
+# known drag on endpoints returning larger payloads (conversation history)
+app = FastAPI(title="AI Researcher Backend", default_response_class=ORJSONResponse)
 
 # --- THIS IS THE FINAL CORRECTED ORIGINS LIST ---
 origins = [
@@ -59,43 +62,127 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- 5. Web Search Function (Unchanged) ---
-def search_web(query: str):
+@app.on_event("startup")
+async def startup():
+    # Warm the asyncpg pool so the first request doesn't pay connection setup
+    await db.get_pool()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await db.close_pool()
+    await http_client.aclose()
+
+# --- 5. Web Search Function (MODIFIED: async, shared client) ---
+# One shared client so connections to Serper are reused across requests
+http_client = httpx.AsyncClient(timeout=10)
+
+async def search_web(query: str):
     url = "https://google.serper.dev/search"
-    payload = json.dumps({"q": query})
     headers = {'X-API-KEY': SERPER_API_KEY, 'Content-Type': 'application/json'}
     try:
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = await http_client.post(url, json={"q": query}, headers=headers)
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error during web search for '{query}': {e}")
         return {"error": f"Search failed for '{query}': {str(e)}"}
 
+# --- NEW: DB helpers (asyncpg pool with Supabase REST fallback) ---
+async def fetch_messages(conversation_id: int) -> List[Dict]:
+    """Fetches all messages of a conversation, oldest first."""
+    pool = await db.get_pool()
+    if pool is not None:
+        rows = await pool.fetch(
+            "SELECT role, content FROM messages "
+            "WHERE conversation_id = $1 ORDER BY created_at",
+            conversation_id
+        )
+        return [dict(row) for row in rows]
+
+    messages_response = await asyncio.to_thread(
+        lambda: supabase_client.table('messages').select('role, content')
+            .eq('conversation_id', conversation_id)
+            .order('created_at', desc=False).execute()
+    )
+    return messages_response.data or []
+
+async def insert_message(conversation_id: int, user_id: str, role: str, content: str):
+    """Appends one message to a conversation."""
+    pool = await db.get_pool()
+    if pool is not None:
+        await pool.execute(
+            "INSERT INTO messages (conversation_id, user_id, role, content) "
+            "VALUES ($1, $2, $3, $4)",
+            conversation_id, user_id, role, content
+        )
+        return
+
+    await asyncio.to_thread(
+        lambda: supabase_client.table('messages').insert({
+            'conversation_id': conversation_id,
+            'user_id': user_id,
+            'role': role,
+            'content': content
+        }).execute()
+    )
+
+# Strong references to in-flight background saves: the event loop only
+# keeps weak refs to tasks, so a bare create_task could be garbage-
+# collected before the history insert runs
+_background_tasks = set()
+
+def spawn_background_task(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def save_ai_message(conversation_id: int, user_id: str, content: str):
+    """Persists the finished AI response; runs as a background task."""
+    try:
+        await insert_message(conversation_id, user_id, 'ai', content)
+        print(f"Successfully saved AI response for conversation ID: {conversation_id}")
+    except Exception as e:
+        print(f"Exception updating history tables: {e}")
+
+async def create_conversation(user_id: str, query: str) -> Optional[int]:
+    """Creates a conversation row and returns its id (None on failure)."""
+    pool = await db.get_pool()
+    if pool is not None:
+        row = await pool.fetchrow(
+            "INSERT INTO conversations (user_id, query_text) "
+            "VALUES ($1, $2) RETURNING id",
+            user_id, query
+        )
+        return row['id'] if row else None
+
+    insert_response = await asyncio.to_thread(
+        lambda: supabase_client.table('conversations').insert({
+            'user_id': user_id,
+            'query_text': query,
+        }).execute()
+    )
+    if insert_response.data and len(insert_response.data) > 0:
+        return insert_response.data[0]['id']
+    return None
+
 # --- NEW: Function to load message history ---
-def load_messages(conversation_id: int): # Corrected type
+async def load_messages(conversation_id: int): # Corrected type
     """Loads previous messages for context."""
     if not conversation_id:
         return []
-    
+
     try:
-        # Corrected sorting parameter
-        messages_response = supabase_client.table('messages').select('role, content') \
-            .eq('conversation_id', conversation_id) \
-            .order('created_at', desc=False).execute() 
-            
-        if messages_response.data:
-            history = []
-            for msg in messages_response.data:
-                history.append({
-                    'role': 'user' if msg['role'] == 'user' else 'model',
-                    'parts': [msg['content']]
-                })
-            return history
+        history = []
+        for msg in await fetch_messages(conversation_id):
+            history.append({
+                'role': 'user' if msg['role'] == 'user' else 'model',
+                'parts': [msg['content']]
+            })
+        return history
     except Exception as e:
         print(f"Error loading history: {e}")
         return []
-    return []
 
 # --- NEW: Function to format sources ---
 def format_search_sources(search_results: Dict) -> str:
@@ -117,49 +204,71 @@ def format_search_sources(search_results: Dict) -> str:
         
     return formatted_sources
 
+# Static prompt skeleton, built once at import; per-request values are
+# formatted in without indented JSON (indentation only inflates the
+# token count billed to Gemini)
+SYSTEM_INSTRUCTION_TEMPLATE = """
+    You are a professional AI Research Agent and Chatbot. Your goal is to provide a comprehensive, well-structured, and helpful response to the user's LATEST query.
+
+    Instructions:
+    1.  Analyze the user's latest query in the context of the CHAT HISTORY.
+    2.  Prioritize information from the USER DOCUMENT CONTEXT (RAG) above all other sources.
+    3.  Supplement your answer using the provided Web Search Results.
+    4.  Format your entire output using clean Markdown.
+    5.  CRITICAL: You MUST include the full list of "TOP WEB SOURCES" at the very end of your response under a "### Sources" heading, using the provided Markdown links.
+
+    CHAT HISTORY:
+    {history_note}
+
+    {rag_section}
+
+    Web Search Results (for synthesis):
+    {knowledge_graph}
+    {answer_box}
+
+    {formatted_sources_list}
+    """
+
 # --- 6. Core Streaming Logic (MODIFIED FOR CHAT CONTINUITY & SOURCES) ---
 async def stream_research_report(query: str, user_id: str, conversation_id: Optional[int] = None):
     full_report_content = ""
     
-    history = load_messages(conversation_id)
-    
+    # History load, web search and RAG retrieval are mutually independent,
+    # so fan them out and pay max(latencies) instead of their sum.
+    history_task = asyncio.create_task(load_messages(conversation_id))
+    search_task = asyncio.create_task(search_web(query))
+    retrieve_task = asyncio.create_task(
+        retrieve_context_async(query, user_id, supabase_client)
+    )
+
     retrieved_context = ""
     try:
-        context_chunks = retrieve_context(query, user_id, supabase_client) 
+        context_chunks = await retrieve_task
         if context_chunks:
             retrieved_context = "\n---\n".join(context_chunks)
             print(f"RAG: Retrieved {len(context_chunks)} chunks for context.")
     except Exception as e:
         print(f"CRITICAL RAG ERROR during retrieval: {e}")
 
+    history = await history_task
+
     if not conversation_id:
         try:
-            insert_response = supabase_client.table('conversations').insert({
-                'user_id': user_id,
-                'query_text': query,
-            }).execute()
-            
-            if insert_response.data and len(insert_response.data) > 0:
-                conversation_id = insert_response.data[0]['id']
-            else:
-                yield "Error: Could not save initial conversation record.\n"
+            conversation_id = await create_conversation(user_id, query)
+            if not conversation_id:
+                yield b"Error: Could not save initial conversation record.\n"
                 return
         except Exception as e:
-            yield f"Error initiating conversation save: {e}\n"
+            yield f"Error initiating conversation save: {e}\n".encode('utf-8')
             return
-            
+
     try:
-        supabase_client.table('messages').insert({
-            'conversation_id': conversation_id,
-            'user_id': user_id,
-            'role': 'user',
-            'content': query
-        }).execute()
+        await insert_message(conversation_id, user_id, 'user', query)
     except Exception as e:
         print(f"Error saving user message to history: {e}")
-        yield f"Warning: Could not save message to history.\n"
+        yield b"Warning: Could not save message to history.\n"
 
-    search_results = search_web(query)
+    search_results = await search_task
     formatted_sources_list = format_search_sources(search_results)
     
     rag_section = ""
@@ -171,59 +280,41 @@ async def stream_research_report(query: str, user_id: str, conversation_id: Opti
         --- END USER DOCUMENT CONTEXT ---
         """
         
-    system_instruction = f"""
-    You are a professional AI Research Agent and Chatbot. Your goal is to provide a comprehensive, well-structured, and helpful response to the user's LATEST query.
-
-    Instructions:
-    1.  Analyze the user's latest query in the context of the CHAT HISTORY.
-    2.  Prioritize information from the USER DOCUMENT CONTEXT (RAG) above all other sources.
-    3.  Supplement your answer using the provided Web Search Results.
-    4.  Format your entire output using clean Markdown.
-    5.  CRITICAL: You MUST include the full list of "TOP WEB SOURCES" at the very end of your response under a "### Sources" heading, using the provided Markdown links.
-
-    CHAT HISTORY:
-    {"[No history]" if not history else "See chat contents."}
-    
-    {rag_section}
-    
-    Web Search Results (for synthesis):
-    {json.dumps(search_results.get('knowledge_graph', {}), indent=2)}
-    {json.dumps(search_results.get('answer_box', {}), indent=2)}
-
-    {formatted_sources_list}
-    """
+    system_instruction = SYSTEM_INSTRUCTION_TEMPLATE.format(
+        history_note="[No history]" if not history else "See chat contents.",
+        rag_section=rag_section,
+        knowledge_graph=orjson.dumps(search_results.get('knowledge_graph', {})).decode(),
+        answer_box=orjson.dumps(search_results.get('answer_box', {})).decode(),
+        formatted_sources_list=formatted_sources_list
+    )
     
     try:
         chat_session = model.start_chat(history=history)
-        
-        response_stream = chat_session.send_message(
+
+        response_stream = await chat_session.send_message_async(
             f"{system_instruction}\n\nUSER'S LATEST QUERY: {query}",
             stream=True
         )
-        
-        for chunk in response_stream:
+
+        # Async iteration + pre-encoded bytes: Starlette ships each yield
+        # as-is and nothing in the loop blocks the event loop
+        async for chunk in response_stream:
             if chunk.text:
-                yield chunk.text
+                yield chunk.text.encode('utf-8')
                 full_report_content += chunk.text
 
     except Exception as e:
         error_message = f"Error during report generation: {str(e)}\n"
         print(error_message)
-        yield f"Sorry, an error occurred while generating the report.\n"
+        yield b"Sorry, an error occurred while generating the report.\n"
         full_report_content = f"Error during generation: {str(e)}"
 
     if conversation_id and full_report_content and not full_report_content.startswith("Error"):
-        try:
-            supabase_client.table('messages').insert({
-                'conversation_id': conversation_id,
-                'user_id': user_id,
-                'role': 'ai',
-                'content': full_report_content
-            }).execute()
-            
-            print(f"Successfully saved AI response for conversation ID: {conversation_id}")
-        except Exception as e:
-            print(f"Exception updating history tables: {e}")
+        # Fire-and-forget so the client isn't kept waiting on the final
+        # history insert after the last token has streamed
+        spawn_background_task(
+            save_ai_message(conversation_id, user_id, full_report_content)
+        )
 
 
 # --- 7. NEW: Endpoint for retrieving a full conversation ---
@@ -231,16 +322,8 @@ async def stream_research_report(query: str, user_id: str, conversation_id: Opti
 async def get_conversation_history(conversation_id: int): # Corrected type
     """Retrieves all messages for a given conversation ID."""
     try:
-        # Corrected sorting parameter
-        messages_response = supabase_client.table('messages').select('role, content') \
-            .eq('conversation_id', conversation_id) \
-            .order('created_at', desc=False).execute() 
-        
-        if messages_response.data:
-            return messages_response.data
-        
-        return []
-        
+        return await fetch_messages(conversation_id)
+
     except Exception as e:
         print(f"Error getting conversation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -271,12 +354,16 @@ async def upload_document(
 
     try:
         file_content = await file.read()
-        raw_text = extract_text_from_file(file_content, file.filename)
+        # Rendering + OCR fan-out blocks its calling thread, so keep it
+        # off the event loop or every other request on this worker stalls
+        raw_text = await asyncio.to_thread(
+            extract_text_from_file, file_content, file.filename
+        )
 
         if raw_text.startswith("ERROR"):
             raise HTTPException(status_code=500, detail=raw_text)
 
-        result = generate_and_save_embeddings(
+        result = await generate_and_save_embeddings(
             raw_text,
             user_id,
             file.filename,
@@ -297,7 +384,7 @@ async def upload_document(
 
 # --- 10. The "Hello World" root ---
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "AI Researcher API is running!"}
 
 # --- 11. Run the Server (Unchanged) ---
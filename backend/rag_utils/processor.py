@@ -1,16 +1,28 @@
 import os
 import io
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import google.generativeai as genai # NEW
 from PIL import Image
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from supabase import Client
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import pytesseract
 from pdf2image import convert_from_bytes
 from dotenv import load_dotenv # NEW
 
+import db
+
 # --- CONFIGURATION ---
 
+# 0. Cap Tesseract's OpenMP threads: we already parallelize OCR one
+# process per page, so letting each Tesseract spawn its own thread team
+# oversubscribes the cores and slows everything down. Must be set before
+# the first tesseract invocation (and is inherited by pool workers).
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 # 1. Load API Key for embedding model
 load_dotenv()
 GOOGLE_GEMINI_API_KEY = os.getenv("GOOGLE_GEMINI_API_KEY")
@@ -21,7 +33,12 @@ genai.configure(api_key=GOOGLE_GEMINI_API_KEY)
 # 2. Define the embedding model we'll use from the API
 EMBEDDING_MODEL = "models/embedding-001"
 
-# 3. Text Splitter (Unchanged)
+# Max number of chunks per embed_content call (API accepts a list of up to 100).
+# Tunable via env so ops can adjust without a code change.
+EMBEDDING_BATCH_SIZE = min(int(os.getenv("EMBEDDING_BATCH_SIZE", "100")), 100)
+
+# 3. Text Splitters
+# Fallback: pure-Python recursive splitter (O(N * depth) over separators)
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=1000,
     chunk_overlap=200,
@@ -29,6 +46,158 @@ text_splitter = RecursiveCharacterTextSplitter(
     separators=["\n\n", "\n", " ", ""]
 )
 
+# Preferred: Rust-backed tokenizer so chunk boundaries are token-count
+# aware and splitting large OCRed PDFs is a single pass instead of
+# Python-level recursion. bert-base-uncased stands in as the token
+# counter since the Gemini embedding model ships no public tokenizer.
+CHUNK_TOKENS = 512
+CHUNK_STRIDE = 100
+
+try:
+    from tokenizers import Tokenizer
+    chunk_tokenizer = Tokenizer.from_pretrained("bert-base-uncased")
+except Exception as e:
+    print(f"Tokenizer unavailable, falling back to character splitter: {e}")
+    chunk_tokenizer = None
+
+
+def split_text(raw_text: str) -> List[str]:
+    """
+    Splits text into chunks of CHUNK_TOKENS tokens with CHUNK_STRIDE overlap.
+
+    Uses the fast tokenizer's offset mapping to slice the original text at
+    token boundaries (no decode round-trip, so OCR artifacts survive
+    untouched). Falls back to the character-based splitter if the
+    tokenizer could not be loaded.
+    """
+    if chunk_tokenizer is None:
+        return text_splitter.split_text(raw_text)
+
+    encoding = chunk_tokenizer.encode(raw_text, add_special_tokens=False)
+    offsets = encoding.offsets
+    if not offsets:
+        return []
+
+    chunks = []
+    step = CHUNK_TOKENS - CHUNK_STRIDE
+    for start in range(0, len(offsets), step):
+        window = offsets[start:start + CHUNK_TOKENS]
+        chunk = raw_text[window[0][0]:window[-1][1]]
+        if chunk.strip():
+            chunks.append(chunk)
+        if start + CHUNK_TOKENS >= len(offsets):
+            break
+    return chunks
+
+# Cache of chunk-hash -> embedding so identical chunks across uploads
+# (re-uploads, shared boilerplate pages) skip the embedding API entirely
+_CHUNK_CACHE_MAX = 8192
+_chunk_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
+
+def _chunk_cache_key(chunk: str) -> str:
+    # Doubles as the content_hash stored in documents (32 hex chars)
+    return hashlib.blake2b(chunk.encode(), digest_size=16).hexdigest()
+
+
+# Query-embedding LRU, shared by the sync path and the batching queue
+_QUERY_CACHE_MAX = 4096
+_query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
+
+def _query_cache_get(query: str):
+    embedding = _query_embedding_cache.get(query)
+    if embedding is not None:
+        _query_embedding_cache.move_to_end(query)
+    return embedding
+
+
+def _query_cache_put(query: str, embedding: List[float]):
+    _query_embedding_cache[query] = embedding
+    while len(_query_embedding_cache) > _QUERY_CACHE_MAX:
+        _query_embedding_cache.popitem(last=False)
+
+
+def _embed_query(query: str) -> List[float]:
+    """
+    Embeds a single query via the API, memoized so repeat queries skip the
+    round-trip.
+    """
+    cached = _query_cache_get(query)
+    if cached is not None:
+        return cached
+
+    response = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=query,
+        task_type="RETRIEVAL_QUERY" # Critical for RAG
+    )
+    embedding = response['embedding']
+    _query_cache_put(query, embedding)
+    return embedding
+
+
+class _QueryEmbedQueue:
+    """
+    Coalesces concurrent query-embedding requests into one API call.
+
+    Under concurrency each /research request would otherwise embed its
+    query in its own round-trip. submit() parks the query for a short
+    window (default 5 ms); a drain task then embeds everything pending in
+    a single embed_content_async call and resolves each waiter's future.
+    """
+
+    def __init__(self, window: float = 0.005):
+        self._window = window
+        self._pending = []
+        self._drain_task = None
+
+    async def submit(self, query: str) -> List[float]:
+        cached = _query_cache_get(query)
+        if cached is not None:
+            return cached
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self):
+        await asyncio.sleep(self._window)
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        # Duplicate queries in the same window share one embedding
+        unique_queries = list(dict.fromkeys(query for query, _ in pending))
+        try:
+            response = await genai.embed_content_async(
+                model=EMBEDDING_MODEL,
+                content=unique_queries,
+                task_type="RETRIEVAL_QUERY" # Critical for RAG
+            )
+            by_query = dict(zip(unique_queries, response['embedding']))
+            for query, future in pending:
+                embedding = by_query[query]
+                _query_cache_put(query, embedding)
+                if not future.done():
+                    future.set_result(embedding)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Queries submitted while the API call above was in flight saw a
+            # not-yet-done drain task and scheduled nothing, so drain again
+            # or their futures would never resolve
+            if self._pending:
+                self._drain_task = asyncio.create_task(self._drain())
+
+
+embed_queue = _QueryEmbedQueue()
+
+
 # --- CORE RAG FUNCTIONS ---
 
 def extract_text_from_file(file_content: bytes, file_name: str) -> str:
@@ -45,15 +214,23 @@ def extract_text_from_file(file_content: bytes, file_name: str) -> str:
         
     elif mime_type == 'pdf':
         try:
-             # Remove poppler_path for Linux compatibility
-             pages = convert_from_bytes(file_content) 
+             # Remove poppler_path for Linux compatibility;
+             # thread_count lets Poppler render pages in parallel
+             pages = convert_from_bytes(file_content, thread_count=os.cpu_count())
         except Exception as e:
              print(f"PDF ERROR: Poppler processing failed. Details: {e}")
              return f"ERROR: Poppler/PDF processing failed. {e}"
 
-        for page in pages:
-            text += pytesseract.image_to_string(page) + "\n\n"
-            
+        # Tesseract is single-threaded per call but pages are independent,
+        # so OCR them across CPU cores instead of one at a time
+        if len(pages) > 1:
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                page_texts = list(executor.map(pytesseract.image_to_string, pages))
+        else:
+            page_texts = [pytesseract.image_to_string(page) for page in pages]
+
+        text = "\n\n".join(page_texts) + "\n\n"
+
     elif mime_type in ['txt', 'md']:
         text = file_content.decode('utf-8')
         
@@ -63,10 +240,64 @@ def extract_text_from_file(file_content: bytes, file_name: str) -> str:
     return text.strip()
 
 
-def generate_and_save_embeddings(
-    raw_text: str, 
-    user_id: str, 
-    file_name: str, 
+async def _embed_chunk_batches(
+    chunks: List[str]
+) -> Tuple[List[Optional[List[float]]], Optional[BaseException]]:
+    """
+    Embeds all chunks in batched API calls, run concurrently.
+
+    The embedding API accepts a list of contents per call, so instead of one
+    round-trip per chunk we send batches of EMBEDDING_BATCH_SIZE and fire the
+    batches in parallel with asyncio.gather.
+
+    Chunks are sorted by length first ("smart batching") so each batch holds
+    similar-sized texts, then the results are unsorted back to input order
+    before returning.
+
+    A failed batch is logged and its chunks come back as None rather than
+    failing the whole upload. Returns (embeddings, first_error), where
+    first_error is None when every batch succeeded.
+    """
+    # Sort by length, remembering the permutation so we can restore order
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    sorted_chunks = [chunks[i] for i in order]
+
+    batches = [
+        sorted_chunks[i:i + EMBEDDING_BATCH_SIZE]
+        for i in range(0, len(sorted_chunks), EMBEDDING_BATCH_SIZE)
+    ]
+
+    responses = await asyncio.gather(*[
+        genai.embed_content_async(
+            model=EMBEDDING_MODEL,
+            content=batch,
+            task_type="RETRIEVAL_DOCUMENT" # Critical for RAG
+        )
+        for batch in batches
+    ], return_exceptions=True)
+
+    sorted_embeddings = []
+    first_error = None
+    for batch, response in zip(batches, responses):
+        if isinstance(response, BaseException):
+            print(f"Error embedding batch of {len(batch)} chunks: {response}")
+            if first_error is None:
+                first_error = response
+            sorted_embeddings.extend([None] * len(batch))
+        else:
+            sorted_embeddings.extend(response['embedding'])
+
+    # Invert the permutation so embeddings line up with the original chunks
+    embeddings = [None] * len(chunks)
+    for sorted_pos, original_pos in enumerate(order):
+        embeddings[original_pos] = sorted_embeddings[sorted_pos]
+    return embeddings, first_error
+
+
+async def generate_and_save_embeddings(
+    raw_text: str,
+    user_id: str,
+    file_name: str,
     supabase_client: Client
 ) -> List[Dict]:
     """
@@ -74,44 +305,122 @@ def generate_and_save_embeddings(
     """
     if raw_text.startswith("ERROR"):
         return [{"error": raw_text}]
-    
-    chunks = text_splitter.split_text(raw_text)
+
+    chunks = split_text(raw_text)
     print(f"Text split into {len(chunks)} chunks.")
-    
+
     data_to_insert = []
-    for chunk in chunks:
-        try:
-            # 2. Generate embedding for each chunk via API
-            embedding_response = genai.embed_content(
-                model=EMBEDDING_MODEL,
-                content=chunk,
-                task_type="RETRIEVAL_DOCUMENT" # Critical for RAG
+    embed_error = None
+    try:
+        # 2. Generate embeddings for all chunks in batched API calls,
+        # skipping chunks whose hash we have already embedded
+        cache_keys = [_chunk_cache_key(chunk) for chunk in chunks]
+        pool = await db.get_pool()
+
+        embeddings = [None] * len(chunks)
+        for i, key in enumerate(cache_keys):
+            cached = _chunk_embedding_cache.get(key)
+            if cached is not None:
+                embeddings[i] = cached
+                _chunk_embedding_cache.move_to_end(key)
+
+        # Consult the documents table for hashes this process hasn't seen;
+        # identical text embeds identically, so stored vectors are reusable
+        unresolved = [i for i in range(len(chunks)) if embeddings[i] is None]
+        if pool is not None and unresolved:
+            db_hits = await db.fetch_embeddings_by_hash(
+                pool, list({cache_keys[i] for i in unresolved})
             )
-            embedding = embedding_response['embedding']
+            for i in unresolved:
+                embedding = db_hits.get(cache_keys[i])
+                if embedding is not None:
+                    embeddings[i] = embedding
+                    _chunk_embedding_cache[cache_keys[i]] = embedding
 
-            # 3. Prepare data for Supabase insert
+        misses = [i for i in range(len(chunks)) if embeddings[i] is None]
+        if misses:
+            new_embeddings, embed_error = await _embed_chunk_batches(
+                [chunks[i] for i in misses]
+            )
+            for i, embedding in zip(misses, new_embeddings):
+                if embedding is None:
+                    # Batch failed; keep the rest of the upload
+                    continue
+                embeddings[i] = embedding
+                _chunk_embedding_cache[cache_keys[i]] = embedding
+        while len(_chunk_embedding_cache) > _CHUNK_CACHE_MAX:
+            _chunk_embedding_cache.popitem(last=False)
+
+        if len(misses) < len(chunks):
+            print(f"Embedding dedup: reused {len(chunks) - len(misses)} of {len(chunks)} chunks.")
+
+        # 3. Prepare data for Supabase insert, dropping chunks that failed
+        # to embed and duplicate chunks within this upload (the table is
+        # unique on user_id/content_hash)
+        seen_hashes = set()
+        for chunk, embedding, content_hash in zip(chunks, embeddings, cache_keys):
+            if embedding is None or content_hash in seen_hashes:
+                continue
+            seen_hashes.add(content_hash)
             data_to_insert.append({
                 'user_id': user_id,
                 'file_name': file_name,
                 'content': chunk,
-                'embedding': embedding
+                'embedding': embedding,
+                'content_hash': content_hash
             })
-        except Exception as e:
-            print(f"Error embedding chunk: {e}")
-            # Skip this chunk and continue
-            pass 
-        
+    except Exception as e:
+        print(f"Error embedding chunks: {e}")
+        embed_error = e
+
     # 4. Save to Supabase
     try:
         if not data_to_insert:
+             if embed_error is not None:
+                 return [{"error": f"Embedding failed: {embed_error}"}]
              return [{"error": "No text could be embedded from the file."}]
-             
-        response = supabase_client.table('documents').insert(data_to_insert).execute()
+
+        # Prefer the direct COPY bulk-load path when DATABASE_URL is set;
+        # for large documents this beats one giant JSON INSERT via PostgREST
+        if pool is not None:
+            try:
+                # Rows the user already has (same file re-uploaded) are skipped
+                existing = await db.fetch_existing_hashes(
+                    pool, user_id, [row['content_hash'] for row in data_to_insert]
+                )
+                new_rows = [
+                    row for row in data_to_insert
+                    if row['content_hash'] not in existing
+                ]
+                if not new_rows:
+                    return [{"success": "All chunks were already saved for this user."}]
+
+                saved = await db.copy_document_chunks(
+                    pool, user_id, file_name,
+                    [row['content'] for row in new_rows],
+                    [row['embedding'] for row in new_rows],
+                    [row['content_hash'] for row in new_rows]
+                )
+                return [{"success": f"Successfully processed and saved {saved} chunks."}]
+            except Exception as e:
+                print(f"COPY bulk insert failed, falling back to REST: {e}")
+
+        # Upsert so chunks the user already has (same file re-uploaded)
+        # are skipped instead of tripping the unique user_id/content_hash
+        # index with a hard error; to_thread keeps the PostgREST round-trip
+        # of a potentially huge payload off the event loop
+        response = await asyncio.to_thread(
+            lambda: supabase_client.table('documents').upsert(
+                data_to_insert,
+                on_conflict='user_id,content_hash',
+                ignore_duplicates=True
+            ).execute()
+        )
 
         if response.data:
             return [{"success": f"Successfully processed and saved {len(response.data)} chunks."}]
         else:
-            return [{"error": f"Failed to insert chunks. DB response: {response.error if hasattr(response, 'error') else 'Unknown'}"}]
+            return [{"success": "All chunks were already saved for this user."}]
             
     except Exception as e:
         return [{"error": f"Critical Database Insert Error: {e}"}]
@@ -124,14 +433,9 @@ def retrieve_context(query: str, user_id: str, supabase_client: Client, top_k: i
     print(f"Retrieving context for user {user_id}...")
     
     try:
-        # 1. Generate embedding for the user's query via API
-        query_embedding_response = genai.embed_content(
-            model=EMBEDDING_MODEL,
-            content=query,
-            task_type="RETRIEVAL_QUERY" # Critical for RAG
-        )
-        query_embedding = query_embedding_response['embedding']
-        
+        # 1. Generate embedding for the user's query via API (cached)
+        query_embedding = _embed_query(query)
+
         # 2. Perform vector search
         rag_query = supabase_client.rpc(
             'match_documents',
@@ -151,4 +455,69 @@ def retrieve_context(query: str, user_id: str, supabase_client: Client, top_k: i
             
     except Exception as e:
         print(f"Error during RAG retrieval: {e}")
-        return []
\ No newline at end of file
+        return []
+
+
+async def retrieve_context_async(
+    query: str,
+    user_id: str,
+    supabase_client: Client,
+    top_k: int = 5
+) -> List[str]:
+    """
+    Async vector search that prefers the direct asyncpg connection.
+
+    When DATABASE_URL is configured the query embedding is sent as a
+    binary pgvector parameter straight to match_documents, skipping the
+    PostgREST JSON round-trip; otherwise falls back to retrieve_context.
+    """
+    pool = await db.get_pool()
+    if pool is None:
+        return await asyncio.to_thread(
+            retrieve_context, query, user_id, supabase_client, top_k
+        )
+
+    try:
+        query_embedding = await embed_queue.submit(query)
+        return await db.fetch_matching_documents(
+            pool, query_embedding, top_k, user_id
+        )
+    except Exception as e:
+        print(f"Error during RAG retrieval: {e}")
+        return []
+
+
+def retrieve_context_batch(
+    query_embeddings: List[List[float]],
+    user_id: str,
+    supabase_client: Client,
+    top_k: int = 5
+) -> List[List[str]]:
+    """
+    Vector search for several query embeddings in a single RPC.
+
+    Uses the match_documents_batch SQL function (one LATERAL JOIN over all
+    embeddings) so N sub-queries cost one round-trip instead of N. Returns
+    one list of matched contents per input embedding, in input order.
+    """
+    if not query_embeddings:
+        return []
+
+    try:
+        rag_query = supabase_client.rpc(
+            'match_documents_batch',
+            {
+                'query_embeddings': query_embeddings,
+                'match_count': top_k,
+                'user_id_param': user_id
+            }
+        ).execute()
+
+        results: List[List[str]] = [[] for _ in query_embeddings]
+        for doc in rag_query.data or []:
+            results[doc['query_index']].append(doc['content'])
+        return results
+
+    except Exception as e:
+        print(f"Error during batched RAG retrieval: {e}")
+        return [[] for _ in query_embeddings]
\ No newline at end of file